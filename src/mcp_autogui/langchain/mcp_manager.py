@@ -12,24 +12,33 @@ class McpManager:
     json_mtime = 0.0
     mcp_tools = []
     tasks = []
-    is_exit = False
     loaded_tasks = 0
 
+    def __init__(self):
+        self.exit_event = asyncio.Event()
+        self.loaded_event = asyncio.Event()
+
     async def load(self, settings_file_path='settings/mcp_config.json'):
         if os.path.isfile(settings_file_path) and self.json_mtime != os.path.getmtime(settings_file_path):
-            self.is_exit = True
+            self.exit_event.set()
             await asyncio.gather(*self.tasks)
             self.tasks = []
             self.mcp_tools = []
-            self.is_exit = False
+            self.exit_event = asyncio.Event()
+            self.loaded_event = asyncio.Event()
             self.json_mtime = os.path.getmtime(settings_file_path)
             with open(settings_file_path, mode='r', encoding='UTF-8') as f:
                 mcp_dict_all = json.load(f)
             self.loaded_tasks = 0
             for target in mcp_dict_all['mcpServers'].values():
                 self.tasks.append(asyncio.create_task(self.add_server(target)))
-            while self.loaded_tasks < len(self.tasks) and not self.is_exit:
-                await asyncio.sleep(0.1)
+            if not self.tasks:
+                self.loaded_event.set()
+            # Wake up as soon as every server is loaded or the servers are stopped
+            waiters = [asyncio.create_task(self.loaded_event.wait()), asyncio.create_task(self.exit_event.wait())]
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
             return True
         return False
 
@@ -52,14 +61,15 @@ class McpManager:
                 await toolkit.initialize() 
                 self.mcp_tools += toolkit.get_tools()
                 self.loaded_tasks += 1
-                while not self.is_exit:
-                    await asyncio.sleep(0.1)
+                if self.loaded_tasks >= len(self.tasks):
+                    self.loaded_event.set()
+                await self.exit_event.wait()
 
     def get_tools(self):
         return self.mcp_tools
 
     def stop_servers(self):
-        self.is_exit = True
+        self.exit_event.set()
 
     def __del__(self):
-        self.is_exit = True
\ No newline at end of file
+        self.exit_event.set()
\ No newline at end of file
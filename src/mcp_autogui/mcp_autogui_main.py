@@ -5,8 +5,9 @@ import sys
 import threading
 import io
 import asyncio
+import concurrent.futures
 import tempfile
-from contextlib import redirect_stdout
+from contextlib import redirect_stdout, contextmanager
 import base64
 import json
 import pyautogui
@@ -15,26 +16,154 @@ from mcp.server.fastmcp import Image
 import PIL
 import pygetwindow as gw
 import requests
+import mss
+import numpy as np
 
 omniparser_path = os.path.join(os.path.dirname(__file__), '..', '..', 'OmniParser')
-sys.path = [omniparser_path, ] + sys.path
-from util.omniparser import Omniparser
-sys.path = sys.path[1:]
+project_root_path = os.path.join(os.path.dirname(__file__), '..', '..')
 
 INPUT_IMAGE_SIZE = 960
+RESULT_JPEG_QUALITY = 85
+
+_mss_local = threading.local()
+_parser_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='omniparser')
+_http_session = requests.Session()
+
+@contextmanager
+def _prepended_sys_path(path):
+    # Only add (and later remove by value) the path if it is not already importable,
+    # so that an existing sys.path entry keeps its position.
+    is_added = path not in sys.path
+    if is_added:
+        sys.path.insert(0, path)
+    try:
+        yield
+    finally:
+        if is_added:
+            sys.path.remove(path)
+
+def _element_positions(element_centers, width, height):
+    # Scale all normalized centers to pixels in one vectorized step (truncating like int()).
+    return (element_centers * np.array([width, height], dtype=np.float64)).astype(np.int64)
+
+def _grab_screen(region=None):
+    # mss handles are bound to the thread that created them, so keep one per thread
+    # and reuse it instead of reinitializing the device context on every capture.
+    sct = getattr(_mss_local, 'sct', None)
+    if sct is None:
+        sct = mss.mss()
+        _mss_local.sct = sct
+    raw = sct.grab(sct.monitors[1] if region is None else region)
+    return PIL.Image.frombytes('RGB', raw.size, raw.bgra, 'raw', 'BGRX')
+
+EVENT_SYSTEM_FOREGROUND = 0x0003
+WINEVENT_OUTOFCONTEXT = 0x0000
+
+_active_window = None
+_foreground_hook_thread = None
+
+def _start_foreground_hook():
+    # Track the foreground window with a WinEvent hook, so that the active window
+    # is only looked up when focus actually changes instead of after every action.
+    global _foreground_hook_thread
+    if os.name != 'nt' or _foreground_hook_thread is not None:
+        return
+
+    import ctypes
+    from ctypes import wintypes
+
+    user32 = ctypes.windll.user32
+    WinEventProc = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND, wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+    user32.SetWinEventHook.argtypes = [wintypes.DWORD, wintypes.DWORD, wintypes.HMODULE, WinEventProc, wintypes.DWORD, wintypes.DWORD, wintypes.DWORD]
+    user32.SetWinEventHook.restype = wintypes.HANDLE
+
+    def foreground_callback(hWinEventHook, event, hwnd, idObject, idChild, dwEventThread, dwmsEventTime):
+        global _active_window
+        if hwnd:
+            _active_window = gw.Win32Window(hwnd)
+
+    def foreground_hook_thread_func():
+        # The hook is delivered through this thread's message loop.
+        callback = WinEventProc(foreground_callback)
+        hook = user32.SetWinEventHook(EVENT_SYSTEM_FOREGROUND, EVENT_SYSTEM_FOREGROUND, 0, callback, 0, 0, WINEVENT_OUTOFCONTEXT)
+        if not hook:
+            return
+        msg = wintypes.MSG()
+        while user32.GetMessageW(ctypes.byref(msg), 0, 0, 0) > 0:
+            user32.TranslateMessage(ctypes.byref(msg))
+            user32.DispatchMessageW(ctypes.byref(msg))
+        user32.UnhookWinEvent(hook)
+
+    _foreground_hook_thread = threading.Thread(target=foreground_hook_thread_func, daemon=True)
+    _foreground_hook_thread.start()
+
+def _get_active_window():
+    if _active_window is None:
+        return gw.getActiveWindow()
+    return _active_window
+
+INPUT_KEYBOARD = 1
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_UNICODE = 0x0004
+VK_TAB = 0x09
+VK_RETURN = 0x0D
+
+if os.name == 'nt':
+    import ctypes
+    from ctypes import wintypes
+
+    class _MOUSEINPUT(ctypes.Structure):
+        _fields_ = [('dx', wintypes.LONG), ('dy', wintypes.LONG), ('mouseData', wintypes.DWORD), ('dwFlags', wintypes.DWORD), ('time', wintypes.DWORD), ('dwExtraInfo', wintypes.WPARAM)]
+
+    class _KEYBDINPUT(ctypes.Structure):
+        _fields_ = [('wVk', wintypes.WORD), ('wScan', wintypes.WORD), ('dwFlags', wintypes.DWORD), ('time', wintypes.DWORD), ('dwExtraInfo', wintypes.WPARAM)]
+
+    class _HARDWAREINPUT(ctypes.Structure):
+        _fields_ = [('uMsg', wintypes.DWORD), ('wParamL', wintypes.WORD), ('wParamH', wintypes.WORD)]
+
+    class _INPUTUNION(ctypes.Union):
+        _fields_ = [('mi', _MOUSEINPUT), ('ki', _KEYBDINPUT), ('hi', _HARDWAREINPUT)]
+
+    class _INPUT(ctypes.Structure):
+        _fields_ = [('type', wintypes.DWORD), ('union', _INPUTUNION)]
+
+def _send_unicode(text):
+    # Type the text with a single SendInput call of KEYEVENTF_UNICODE key down/up pairs.
+    # Characters outside the BMP are sent as their UTF-16 surrogate pairs.
+    # Line breaks and tabs are sent as real Enter/Tab key presses, which apps handle
+    # unlike unicode packets for control characters.
+    text = text.replace('\r\n', '\n').replace('\r', '')
+    code_units = memoryview(text.encode('utf-16-le')).cast('H')
+    virtual_keys = {ord('\n'): VK_RETURN, ord('\t'): VK_TAB}
+    inputs = (_INPUT * (len(code_units) * 2))()
+    for loop, code_unit in enumerate(code_units):
+        virtual_key = virtual_keys.get(code_unit)
+        for offset, key_up in enumerate((0, KEYEVENTF_KEYUP)):
+            inputs[loop * 2 + offset].type = INPUT_KEYBOARD
+            if virtual_key is None:
+                inputs[loop * 2 + offset].union.ki = _KEYBDINPUT(0, code_unit, KEYEVENTF_UNICODE | key_up, 0, 0)
+            else:
+                inputs[loop * 2 + offset].union.ki = _KEYBDINPUT(virtual_key, 0, key_up, 0, 0)
+    sent = ctypes.windll.user32.SendInput(len(inputs), inputs, ctypes.sizeof(_INPUT))
+    if 0 < sent < len(inputs):
+        print(f'SendInput only injected {sent} of {len(inputs)} key events.', file=sys.stderr)
+    # Only report failure when nothing was injected; after a partial send, a fallback
+    # that types the whole text again would duplicate the characters already sent.
+    return sent > 0
 
 def mcp_autogui_main(mcp):
     global omniparser
     omniparser = None
     input_image_path = ''
     output_dir_path = ''
-    omniparser_thread = None
-    result_image = None
+    omniparser_load_future = None
+    parse_future = None
     input_image_resized_path = None
     detail = None
-    is_finished = False
+    element_positions = None
 
     current_mouse_x, current_mouse_y = pyautogui.position()
+    screen_size = pyautogui.size()
     is_set_target_window = False
     match_windows = None
     if 'TARGET_WINDOW_NAME' in os.environ:
@@ -43,36 +172,111 @@ def mcp_autogui_main(mcp):
         current_window = match_windows[0]
         is_set_target_window = True
     else:
-        current_window = gw.getActiveWindow()
-    with redirect_stdout(sys.stderr):
-        config = {
-            'som_model_path': os.environ['SOM_MODEL_PATH'] if 'SOM_MODEL_PATH' in os.environ else os.path.join(omniparser_path, 'weights/icon_detect/model.pt'),
-            'caption_model_name': os.environ['CAPTION_MODEL_NAME'] if 'CAPTION_MODEL_NAME' in os.environ else 'florence2',
-            'caption_model_path': os.environ['CAPTION_MODEL_PATH'] if 'CAPTION_MODEL_PATH' in os.environ else os.path.join(omniparser_path, 'weights/icon_caption_florence'),
-            'device': os.environ['OMNI_PARSER_DEVICE'] if 'OMNI_PARSER_DEVICE' in os.environ else 'cuda',
-            'BOX_TRESHOLD': float(os.environ['BOX_TRESHOLD']) if 'BOX_TRESHOLD' in os.environ else 0.05,
-        }
+        _start_foreground_hook()
+        current_window = _get_active_window()
+    config = {
+        'som_model_path': os.environ['SOM_MODEL_PATH'] if 'SOM_MODEL_PATH' in os.environ else os.path.join(omniparser_path, 'weights/icon_detect/model.pt'),
+        'caption_model_name': os.environ['CAPTION_MODEL_NAME'] if 'CAPTION_MODEL_NAME' in os.environ else 'florence2',
+        'caption_model_path': os.environ['CAPTION_MODEL_PATH'] if 'CAPTION_MODEL_PATH' in os.environ else os.path.join(omniparser_path, 'weights/icon_caption_florence'),
+        'device': os.environ['OMNI_PARSER_DEVICE'] if 'OMNI_PARSER_DEVICE' in os.environ else 'cuda',
+        'BOX_TRESHOLD': float(os.environ['BOX_TRESHOLD']) if 'BOX_TRESHOLD' in os.environ else 0.05,
+    }
+    precision = os.environ['OMNI_PRECISION'] if 'OMNI_PRECISION' in os.environ else 'fp32'
+    use_fp16 = precision == 'fp16' and config['device'].startswith('cuda')
+
+    def load_omniparser():
+        global omniparser
+
+        # Imported here so that torch and the models are only loaded when they are needed.
+        with redirect_stdout(sys.stderr):
+            with _prepended_sys_path(project_root_path):
+                from download_models import download_omniparser_models
+            download_omniparser_models()
 
-        if not 'OMNI_PARSER_SERVER' in os.environ:
-            def omniparser_start_thread_func():
-                global omniparser
+            with _prepended_sys_path(omniparser_path):
+                from util.omniparser import Omniparser
+
+            omniparser = Omniparser(config)
+        if use_fp16:
+            caption_model_processor = getattr(omniparser, 'caption_model_processor', None)
+            if caption_model_processor is not None:
+                caption_model_processor['model'] = caption_model_processor['model'].half()
+        #print('Loading Omniparser is finished.', file=sys.stderr)
+
+    # Loading runs on the parser pool, so it is always finished before the first parse.
+    if not 'OMNI_PARSER_SERVER' in os.environ and 'OMNI_PARSER_BACKEND_LOAD' in os.environ and os.environ['OMNI_PARSER_BACKEND_LOAD']:
+        omniparser_load_future = _parser_pool.submit(load_omniparser)
 
-                sys.path = [os.path.join(os.path.dirname(__file__), '..', '..'), ] + sys.path
-                from download_models import download_omniparser_models
-                download_omniparser_models()
-                sys.path = sys.path[1:]
-
-                omniparser = Omniparser(config)
-                #print('Loading Omniparser is finished.', file=sys.stderr)
-            if 'OMNI_PARSER_BACKEND_LOAD' in os.environ and os.environ['OMNI_PARSER_BACKEND_LOAD']:
-                omniparser_start_thread = threading.Thread(target=omniparser_start_thread_func)
-                omniparser_start_thread.start()
-            else:
-                omniparser_start_thread_func()
-        
     temp_dir = tempfile.TemporaryDirectory()
     dname = temp_dir.name
 
+    def capture_screen():
+        if is_set_target_window:
+            current_window.activate()
+
+        if is_set_target_window:
+            # Only grab the target window, which also keeps the model input small.
+            screenshot_image = _grab_screen({'left': current_window.left, 'top': current_window.top, 'width': current_window.width, 'height': current_window.height})
+        else:
+            screenshot_image = _grab_screen()
+
+        return (screenshot_image, )
+
+    @contextmanager
+    def inference_context():
+        # OmniParser prints progress to stdout, which would corrupt the stdio MCP stream.
+        with redirect_stdout(sys.stderr):
+            if not use_fp16:
+                yield
+                return
+            import torch
+            with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16):
+                yield
+
+    def parse_screen(screenshot_image):
+        if 'OMNI_PARSER_SERVER' in os.environ:
+            buffered = io.BytesIO()
+            screenshot_image.save(buffered, format='png')
+            send_img = base64.b64encode(buffered.getvalue()).decode('ascii')
+            json_data = json.dumps({'base64_image': send_img})
+            response = _http_session.post(
+                f"http://{os.environ['OMNI_PARSER_SERVER']}/parse/",
+                data=json_data,
+                headers={"Content-Type": "application/json"}
+            )
+            response_json = response.json()
+            dino_labled_img = response_json['som_image_base64']
+            detail_local = response_json['parsed_content_list']
+            result_image_local = PIL.Image.open(io.BytesIO(base64.b64decode(dino_labled_img)))
+        else:
+            with inference_context():
+                dino_labled_img, detail_local = omniparser.parse_raw(screenshot_image)
+            result_image_local = PIL.Image.open(io.BytesIO(base64.b64decode(dino_labled_img)))
+
+        return result_image_local, detail_local
+
+    def render_result(result_image_local, detail_local):
+        import cv2
+
+        result_image_local.thumbnail((INPUT_IMAGE_SIZE, INPUT_IMAGE_SIZE), PIL.Image.LANCZOS)
+
+        result_array = cv2.cvtColor(np.asarray(result_image_local.convert('RGB')), cv2.COLOR_RGB2BGR)
+        success, result_image = cv2.imencode('.jpg', result_array, [int(cv2.IMWRITE_JPEG_QUALITY), RESULT_JPEG_QUALITY])
+        if not success:
+            raise RuntimeError('Failed to encode the screen capture as JPEG.')
+
+        detail_text = ''.join(f'ID: {loop}, {content["type"]}: {content["content"]}\n' for loop, content in enumerate(detail_local))
+
+        # bbox is normalized to the screenshot, so the centers only need scaling by the captured area later.
+        boxes = np.array([content['bbox'] for content in detail_local], dtype=np.float64).reshape(-1, 4)
+        element_centers_local = (boxes[:, 0:2] + boxes[:, 2:4]) / 2
+
+        return detail_local, element_centers_local, detail_text, result_image.tobytes()
+
+    def analyze_screen():
+        # Runs as one job on the parser pool, which also keeps a single mss instance on its thread.
+        return render_result(*parse_screen(*capture_screen()))
+
     @mcp.tool()
     async def omniparser_details_on_screen() -> list:
         """Get the screen and analyze its details.
@@ -82,71 +286,48 @@ Return value:
     - Details such as the content of text.
     - Screen capture with ID number added.
 """
-        nonlocal omniparser_thread, result_image, detail, is_finished
+        nonlocal omniparser_load_future, parse_future, detail, element_positions, screen_size
 
         if not 'OMNI_PARSER_SERVER' in os.environ:
-            while omniparser is None:
-                await asyncio.sleep(0.1)
+            if omniparser_load_future is None:
+                omniparser_load_future = _parser_pool.submit(load_omniparser)
+            try:
+                await asyncio.shield(asyncio.wrap_future(omniparser_load_future))
+            except Exception:
+                omniparser_load_future = None
+                raise
+
+        # A new screenshot is a natural point to pick up screen configuration changes.
+        screen_size = pyautogui.size()
+
+        # Keep the pending analysis across calls so that a call retried after a
+        # timeout waits for the same result instead of queueing another one.
+        if parse_future is None:
+            parse_future = asyncio.wrap_future(_parser_pool.submit(analyze_screen))
+        try:
+            detail, element_centers, detail_text, result_image = await asyncio.shield(parse_future)
+        finally:
+            if parse_future.done():
+                parse_future = None
+
+        # Resolve every element to pixels in the captured area once, so that clicks only add the origin.
+        if is_set_target_window:
+            capture_width, capture_height = current_window.width, current_window.height
+        else:
+            capture_width, capture_height = screen_size
+        element_positions = _element_positions(element_centers, capture_width, capture_height)
 
-        detail_text = ''
-        with redirect_stdout(sys.stderr):
-            def omniparser_thread_func():
-                nonlocal result_image, detail, is_finished, detail_text
-                with redirect_stdout(sys.stderr):
-                    if is_set_target_window:
-                        current_window.activate()
-
-                    screenshot_image = pyautogui.screenshot()
-
-                    if is_set_target_window:
-                        screenshot_image = screenshot_image.crop((current_window.left, current_window.top, current_window.right, current_window.bottom))
-
-                    if 'OMNI_PARSER_SERVER' in os.environ:
-                        buffered = io.BytesIO()
-                        screenshot_image.save(buffered, format='png')
-                        send_img = base64.b64encode(buffered.getvalue()).decode('ascii')
-                        json_data = json.dumps({'base64_image': send_img})
-                        response = requests.post(
-                            f"http://{os.environ['OMNI_PARSER_SERVER']}/parse/",
-                            data=json_data,
-                            headers={"Content-Type": "application/json"}
-                        )
-                        response_json = response.json()
-                        dino_labled_img = response_json['som_image_base64']
-                        detail = response_json['parsed_content_list']
-                    else:
-                        dino_labled_img, detail = omniparser.parse_raw(screenshot_image)
-
-                    image_bytes = base64.b64decode(dino_labled_img)
-                    result_image_local = PIL.Image.open(io.BytesIO(image_bytes))
-
-                    width, height = result_image_local.size
-                    if width > height:
-                        result_image_local = result_image_local.resize((INPUT_IMAGE_SIZE, INPUT_IMAGE_SIZE * height // width))
-                    else:
-                        result_image_local = result_image_local.resize((INPUT_IMAGE_SIZE * width // height, INPUT_IMAGE_SIZE))
-
-                    result_image = io.BytesIO()
-                    result_image_local.save(result_image, format='png')
-
-                    detail_text = ''
-                    for loop, content in enumerate(detail):
-                        detail_text += f'ID: {loop}, {content["type"]}: {content["content"]}\n'
-
-                    is_finished = True
-            if omniparser_thread is None:
-                result_image = None
-                detail = None
-                is_finished = False
-                omniparser_thread = threading.Thread(target=omniparser_thread_func)
-                omniparser_thread.start()
-            
-            while not is_finished:
-                await asyncio.sleep(0.1)
-
-            omniparser_thread = None
-
-            return [detail_text, Image(data=result_image.getvalue(), format="png")]
+        return [detail_text, Image(data=result_image, format="jpeg")]
+
+    def get_window_origin():
+        if is_set_target_window:
+            current_window.activate()
+            return current_window.left, current_window.top
+        return 0, 0
+
+    def element_position(id, left, top):
+        x, y = element_positions[id].tolist()
+        return x + left, y + top
 
     @mcp.tool()
     async def omniparser_click(id: int, button: str = 'left', clicks: int = 1) -> bool:
@@ -160,21 +341,12 @@ Return value:
     True is success. False is means "this is not found".
 """
         nonlocal current_mouse_x, current_mouse_y, current_window
-        screen_width, screen_height = pyautogui.size()
-        if len(detail) > id:
-            if is_set_target_window:
-                current_window.activate()
-                left = current_window.left
-                top = current_window.top
-            else:
-                left = 0
-                top = 0
-            compos = detail[id]['bbox']
-            current_mouse_x = int((compos[0] + compos[2]) * screen_width) // 2 + left
-            current_mouse_y = int((compos[1] + compos[3]) * screen_height) // 2 + top
+        if len(element_positions) > id:
+            left, top = get_window_origin()
+            current_mouse_x, current_mouse_y = element_position(id, left, top)
             pyautogui.click(x=current_mouse_x, y=current_mouse_y, button=button, clicks=clicks)
             if not is_set_target_window:
-                current_window = gw.getActiveWindow()
+                current_window = _get_active_window()
             return True
         return False
 
@@ -191,26 +363,12 @@ Return value:
     True is success. False is means "this is not found".
 """
         nonlocal current_mouse_x, current_mouse_y, current_window
-        screen_width, screen_height = pyautogui.size()
-
-        if is_set_target_window:
-            current_window.activate()
-            left = current_window.left
-            top = current_window.top
-        else:
-            left = 0
-            top = 0
+        left, top = get_window_origin()
 
-        from_x = -1
-        to_x = -1
-        if len(detail) <= from_id or len(detail) <= to_id:
+        if len(element_positions) <= from_id or len(element_positions) <= to_id:
             return False
-        compos = detail[from_id]['bbox']
-        from_x = int((compos[0] + compos[2]) * screen_width) // 2 + left
-        from_y = int((compos[1] + compos[3]) * screen_height) // 2 + top
-        compos = detail[to_id]['bbox']
-        to_x = int((compos[0] + compos[2]) * screen_width) // 2 + left
-        to_y = int((compos[1] + compos[3]) * screen_height) // 2 + top
+        from_x, from_y = element_position(from_id, left, top)
+        to_x, to_y = element_position(to_id, left, top)
 
         if key is not None and key != '':
             pyautogui.keyDown(key)
@@ -221,7 +379,7 @@ Return value:
         current_mouse_x = to_x
         current_mouse_y = to_y
         if not is_set_target_window:
-            current_window = gw.getActiveWindow()
+            current_window = _get_active_window()
         return True
 
     @mcp.tool()
@@ -234,22 +392,13 @@ Return value:
     True is success. False is means "this is not found".
 """
         nonlocal current_mouse_x, current_mouse_y, current_window
-        screen_width, screen_height = pyautogui.size()
-        if len(detail) <= id:
+        if len(element_positions) <= id:
             return False
-        compos = detail[id]['bbox']
-        if is_set_target_window:
-            current_window.activate()
-            left = current_window.left
-            top = current_window.top
-        else:
-            left = 0
-            top = 0
-        current_mouse_x = int((compos[0] + compos[2]) * screen_width) // 2 + left
-        current_mouse_y = int((compos[1] + compos[3]) * screen_height) // 2 + top
+        left, top = get_window_origin()
+        current_mouse_x, current_mouse_y = element_position(id, left, top)
         pyautogui.moveTo(current_mouse_x, current_mouse_y)
         if not is_set_target_window:
-            current_window = gw.getActiveWindow()
+            current_window = _get_active_window()
         return True
 
     @mcp.tool()
@@ -278,7 +427,8 @@ Args:
             pyautogui.moveTo(current_mouse_x, current_mouse_y)
         if content.isascii():
             pyautogui.write(content)
-        else:
+        elif not (os.name == 'nt' and _send_unicode(content)):
+            # Paste through the clipboard where SendInput is not available
             prev_clip = pyperclip.paste()
             pyperclip.copy(content)
             pyautogui.hotkey('ctrl', 'v')
@@ -5,6 +5,7 @@ OmniParser client for screen analysis
 
 import asyncio
 import base64
+import concurrent.futures
 import io
 import json
 import logging
@@ -12,11 +13,15 @@ import os
 import time
 from typing import Any, Dict, List, Optional
 
-import requests
+import httpx
 from PIL import Image
+from rapidfuzz import fuzz, process
 
 logger = logging.getLogger(__name__)
 
+# Minimum partial_ratio score (0-100) for a caption to count as a match
+MATCH_SCORE_CUTOFF = 80
+
 class OmniParserClient:
     """Client for OmniParser screen analysis"""
     
@@ -32,6 +37,11 @@ class OmniParserClient:
         self.box_threshold = float(os.environ.get("BOX_THRESHOLD", "0.05"))
         
         self._omniparser = None
+        self._http = None
+        self._captions_cache = (None, [])
+        # The models are held in this process and are not picklable, so a process pool
+        # is not an option; a single pinned thread keeps inference serialized instead.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="omniparser")
         
         logger.info(f"OmniParserClient initialized. Server: {self.server_url}, Backend load: {self.backend_load}")
     
@@ -68,10 +78,13 @@ class OmniParserClient:
                 "task_description": task_description
             }
             
-            response = requests.post(
+            # One client for the lifetime of the process so connections are pooled
+            if self._http is None:
+                self._http = httpx.AsyncClient(timeout=30)
+            
+            response = await self._http.post(
                 f"http://{self.server_url}/analyze",
-                json=payload,
-                timeout=30
+                json=payload
             )
             
             if response.status_code == 200:
@@ -92,6 +105,12 @@ class OmniParserClient:
             logger.error(f"Error in remote analysis: {e}")
             return {"success": False, "error": str(e)}
     
+    async def aclose(self):
+        """Close the HTTP client used for remote analysis"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+    
     async def _analyze_local(self, screenshot_b64: str, task_description: str) -> Dict[str, Any]:
         """Analyze screenshot using local OmniParser"""
         try:
@@ -104,8 +123,8 @@ class OmniParserClient:
             image = Image.open(io.BytesIO(image_data))
             
             # Run OmniParser analysis
-            result = await asyncio.get_event_loop().run_in_executor(
-                None, self._run_omniparser_analysis, image, task_description
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._run_omniparser_analysis, image, task_description
             )
             
             return {
@@ -126,13 +145,17 @@ class OmniParserClient:
             import sys
             import os
             
-            # Add OmniParser to path
+            # Add OmniParser to path only for the duration of the import
             omniparser_path = os.path.join(os.path.dirname(__file__), '..', '..', 'OmniParser')
-            if omniparser_path not in sys.path:
-                sys.path.append(omniparser_path)
-            
-            from OmniParser.som import SoMModel
-            from OmniParser.caption import CaptionModel
+            is_path_added = omniparser_path not in sys.path
+            if is_path_added:
+                sys.path.insert(0, omniparser_path)
+            try:
+                from OmniParser.som import SoMModel
+                from OmniParser.caption import CaptionModel
+            finally:
+                if is_path_added:
+                    sys.path.remove(omniparser_path)
             
             # Initialize models
             som_model = SoMModel(
@@ -170,16 +193,18 @@ class OmniParserClient:
             # Run SoM (Set of Marks) detection
             som_results = som_model.detect(image)
             
-            # Run caption generation for detected elements
+            # Extract element regions
+            crops = [image.crop(tuple(map(int, box))) for box in som_results['boxes']]
+            
+            # Run caption generation for detected elements in one batch when supported
+            if hasattr(caption_model, 'generate_captions_batch'):
+                captions = caption_model.generate_captions_batch(crops)
+            else:
+                captions = [caption_model.generate_caption(element_image) for element_image in crops]
+            
             elements = []
-            for i, (box, score) in enumerate(zip(som_results['boxes'], som_results['scores'])):
-                # Extract element region
+            for i, (box, score, caption) in enumerate(zip(som_results['boxes'], som_results['scores'], captions)):
                 x1, y1, x2, y2 = box
-                element_image = image.crop((x1, y1, x2, y2))
-                
-                # Generate caption
-                caption = caption_model.generate_caption(element_image)
-                
                 elements.append({
                     'id': i,
                     'box': [int(x1), int(y1), int(x2), int(y2)],
@@ -206,23 +231,34 @@ class OmniParserClient:
                 return None
             
             elements = analysis_result['analysis'].get('elements', [])
+            
+            # Lowercased captions are computed once per analysis result
+            cached_elements, captions = self._captions_cache
+            if cached_elements is not elements:
+                captions = [element.get('caption', '').lower() for element in elements]
+                self._captions_cache = (elements, captions)
+            
+            # Fuzzy substring matching: the description has to (approximately) appear in the caption,
+            # so captions shorter than the description are not candidates
             description_lower = description.lower()
+            candidates = {
+                index: caption
+                for index, caption in enumerate(captions)
+                if len(caption) >= len(description_lower)
+            }
+            matches = process.extract(
+                description_lower,
+                candidates,
+                scorer=fuzz.partial_ratio,
+                score_cutoff=MATCH_SCORE_CUTOFF,
+                limit=None
+            )
+            if not matches:
+                return None
             
-            # Simple matching - could be enhanced with semantic similarity
-            best_match = None
-            best_score = 0
-            
-            for element in elements:
-                caption = element.get('caption', '').lower()
-                
-                # Simple keyword matching
-                if description_lower in caption:
-                    score = len(description_lower) / len(caption) if caption else 0
-                    if score > best_score:
-                        best_score = score
-                        best_match = element
-            
-            return best_match
+            # Among equally good matches, prefer the caption the description covers most of
+            _, _, index = max(matches, key=lambda match: (match[1], len(description_lower) / len(match[0])))
+            return elements[index]
         
         except Exception as e:
             logger.error(f"Error finding element by description: {e}")
@@ -222,16 +222,19 @@ async def serve():
         # For now, fall back to stdio
         pass
     
-    async with stdio_server() as (read_stream, write_stream):
-        await server_instance.server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="omniparser-autogui-mcp",
-                server_version="0.1.0",
-                capabilities=server_instance.server.get_capabilities(
-                    notification_options=None,
-                    experimental_capabilities={}
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await server_instance.server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="omniparser-autogui-mcp",
+                    server_version="0.1.0",
+                    capabilities=server_instance.server.get_capabilities(
+                        notification_options=None,
+                        experimental_capabilities={}
+                    )
                 )
             )
-        )
+    finally:
+        await server_instance.omniparser_client.aclose()
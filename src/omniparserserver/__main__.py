@@ -10,7 +10,13 @@ from omniparserserver.server import serve
 def main():
     """Main entry point"""
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(serve())
+    try:
+        # uvloop is not available on Windows
+        import uvloop
+    except ImportError:
+        asyncio.run(serve())
+    else:
+        asyncio.run(serve(), loop_factory=uvloop.new_event_loop)
 
 if __name__ == "__main__":
     main()
@@ -4,100 +4,257 @@ Remote OmniParser processing server
 """
 
 import asyncio
-import base64
+import binascii
+import concurrent.futures
+import functools
 import io
+import itertools
 import json
 import logging
+import math
 import os
-from typing import Any, Dict
+import sys
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException
+import numpy as np
+import orjson
+import torch
+import torchvision
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from PIL import Image
 import uvicorn
 
+OMNIPARSER_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'OmniParser')
+
+# Set up the OmniParser import path once, instead of on every initialization
+if 'OmniParser.som' not in sys.modules and OMNIPARSER_PATH not in sys.path:
+    sys.path.append(OMNIPARSER_PATH)
+
+from OmniParser.som import SoMModel
+from OmniParser.caption import CaptionModel
+
 logger = logging.getLogger(__name__)
 
-class AnalysisRequest(BaseModel):
-    image: str  # base64 encoded
-    task_description: str
+# Pre-encoded body for the health check endpoint
+HEALTH_JSON = b'{"status":"healthy","service":"omniparser-server"}'
+
+# Values accepted by CAPTION_DTYPE (only applied on GPU devices, through autocast)
+CAPTION_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}
+
+# (mode, rawmode) pairs accepted by /analyze_raw, with the bytes per pixel of the raw data.
+# mss screen grabs are BGRA/BGRX, which Pillow unpacks without a separate swizzle.
+RAW_IMAGE_FORMATS = {
+    ("L", "L"): 1,
+    ("RGB", "RGB"): 3,
+    ("RGB", "BGR"): 3,
+    ("RGB", "RGBX"): 4,
+    ("RGB", "BGRX"): 4,
+    ("RGBA", "RGBA"): 4,
+    ("RGBA", "BGRA"): 4,
+    ("RGBX", "RGBX"): 4,
+}
+
+@dataclass(frozen=True)
+class Config:
+    """Server settings, read from the environment once"""
+    som_model_path: Optional[str]
+    caption_model_name: Optional[str]
+    caption_model_path: Optional[str]
+    device: str
+    box_threshold: float
+    nms_iou_threshold: Optional[float]
+    caption_max_batch: int
+    caption_dtype: torch.dtype
+    host: str
+    port: int
+    workers: int
+    cors_origins: Tuple[str, ...]
+    som_input_size: Optional[int]
+    
+    @classmethod
+    def from_env(cls) -> "Config":
+        nms_iou_threshold = os.environ.get("NMS_IOU_THRESHOLD")
+        som_input_size = os.environ.get("SOM_INPUT_SIZE")
+        caption_max_batch = int(os.environ.get("CAPTION_MAX_BATCH", "32"))
+        if caption_max_batch < 1:
+            # An empty first batch would leave every element without a caption, dropping them all
+            raise ValueError(f"CAPTION_MAX_BATCH must be at least 1, got {caption_max_batch}")
+        caption_dtype = os.environ.get("CAPTION_DTYPE", "fp32")
+        if caption_dtype not in CAPTION_DTYPES:
+            raise ValueError(f"CAPTION_DTYPE must be one of {', '.join(CAPTION_DTYPES)}, got {caption_dtype!r}")
+        workers = int(os.environ.get("INFER_WORKERS", "1"))
+        if workers < 1:
+            raise ValueError(f"INFER_WORKERS must be at least 1, got {workers}")
+        return cls(
+            som_model_path=os.environ.get("SOM_MODEL_PATH"),
+            caption_model_name=os.environ.get("CAPTION_MODEL_NAME"),
+            caption_model_path=os.environ.get("CAPTION_MODEL_PATH"),
+            device=os.environ.get("OMNI_PARSER_DEVICE", "cpu"),
+            box_threshold=float(os.environ.get("BOX_THRESHOLD", "0.05")),
+            nms_iou_threshold=float(nms_iou_threshold) if nms_iou_threshold else None,
+            caption_max_batch=caption_max_batch,
+            caption_dtype=CAPTION_DTYPES[caption_dtype],
+            host=os.environ.get("SSE_HOST", "127.0.0.1"),
+            port=int(os.environ.get("SSE_PORT", "8000")),
+            workers=workers,
+            # CORS is only needed for browser clients on other origins
+            cors_origins=tuple(origin.strip() for origin in os.environ.get("CORS_ORIGINS", "").split(",") if origin.strip()),
+            # Longest side the detector works at; large JPEGs are decoded at a reduced scale down to it
+            som_input_size=int(som_input_size) if som_input_size else None,
+        )
+
+CFG = Config.from_env()
 
 class OmniParserServer:
     def __init__(self):
-        self.app = FastAPI(title="OmniParser Server", version="0.1.0")
+        self.app = FastAPI(title="OmniParser Server", version="0.1.0", default_response_class=ORJSONResponse)
         self._omniparser = None
+        
+        # Bounded inference pool, reused across requests; extra requests wait on the semaphore
+        workers = CFG.workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="omniparser")
+        self._sem = asyncio.Semaphore(workers)
+        self._init_lock = asyncio.Lock()
+        
         self._setup_routes()
         self._setup_middleware()
     
     def _setup_middleware(self):
-        self.app.add_middleware(
-            CORSMiddleware,
-            allow_origins=["*"],
-            allow_credentials=True,
-            allow_methods=["*"],
-            allow_headers=["*"],
-        )
+        # Skip the CORS middleware unless origins are configured
+        if CFG.cors_origins:
+            self.app.add_middleware(
+                CORSMiddleware,
+                allow_origins=list(CFG.cors_origins),
+                allow_credentials=True,
+                allow_methods=["GET", "POST"],
+                allow_headers=["content-type"],
+            )
+        
+        # Element lists with captions are repetitive JSON and compress well; tiny replies are left alone
+        self.app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=4)
     
     def _setup_routes(self):
         @self.app.get("/")
         async def health_check():
-            return {"status": "healthy", "service": "omniparser-server"}
+            return Response(content=HEALTH_JSON, media_type="application/json")
         
         @self.app.post("/analyze")
-        async def analyze_image(request: AnalysisRequest):
+        async def analyze_image(request: Request):
+            # Parsed by hand: a model would walk and copy the (large) base64 string again
             try:
-                # Initialize OmniParser if needed
-                if self._omniparser is None:
-                    await self._initialize_omniparser()
-                
-                # Decode image
-                image_data = base64.b64decode(request.image)
-                image = Image.open(io.BytesIO(image_data))
-                
-                # Run analysis
-                result = await asyncio.get_event_loop().run_in_executor(
-                    None, self._run_analysis, image, request.task_description
+                body = orjson.loads(await request.body())
+                image_b64 = body["image"]  # base64 encoded
+                task_description = body["task_description"]
+            except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+                raise HTTPException(status_code=422, detail=f"Invalid request body: {e!r}")
+            if not isinstance(image_b64, str) or not isinstance(task_description, str):
+                raise HTTPException(status_code=422, detail="image and task_description must be strings")
+            
+            # Decode image
+            return await self._analyze(functools.partial(self._open_base64_image, image_b64), task_description)
+        
+        @self.app.post("/analyze_file")
+        async def analyze_image_file(image: UploadFile = File(...), task_description: str = Form(...)):
+            # Raw PNG/JPEG bytes as multipart/form-data, without the base64 overhead
+            image_data = await image.read()
+            return await self._analyze(functools.partial(self._open_image, image_data), task_description)
+        
+        @self.app.post("/analyze_raw")
+        async def analyze_image_raw(
+            image: UploadFile = File(...),
+            width: int = Form(...),
+            height: int = Form(...),
+            mode: str = Form("RGBA"),
+            rawmode: Optional[str] = Form(None),
+            task_description: str = Form(...)
+        ):
+            # Uncompressed pixels (e.g. straight from a screen grab), without any PNG encode/decode.
+            # rawmode is the layout of the uploaded bytes (e.g. BGRX from mss), defaulting to mode.
+            rawmode = rawmode or mode
+            bytes_per_pixel = RAW_IMAGE_FORMATS.get((mode, rawmode))
+            if bytes_per_pixel is None:
+                raise HTTPException(status_code=400, detail=f"Unsupported mode/rawmode: {mode}/{rawmode}")
+            if width <= 0 or height <= 0:
+                raise HTTPException(status_code=400, detail="width and height must be positive")
+            image_data = await image.read()
+            if len(image_data) != width * height * bytes_per_pixel:
+                raise HTTPException(status_code=400, detail="Image data size does not match width, height and rawmode")
+            # frombuffer references the uploaded bytes instead of copying them where Pillow allows it
+            return await self._analyze(
+                functools.partial(Image.frombuffer, mode, (width, height), image_data, 'raw', rawmode, 0, 1),
+                task_description
+            )
+    
+    @classmethod
+    def _open_base64_image(cls, image_b64: str) -> Image.Image:
+        """Decode a base64 image and open it"""
+        return cls._open_image(binascii.a2b_base64(image_b64))
+    
+    @staticmethod
+    def _open_image(image_data) -> Image.Image:
+        """Open and decode an encoded (PNG/JPEG) image from bytes"""
+        # BytesIO shares the bytes object instead of copying it
+        image = Image.open(io.BytesIO(image_data))
+        source_size = image.size
+        if image.format == 'JPEG' and CFG.som_input_size and max(source_size) > CFG.som_input_size:
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the detector input size
+            scale = CFG.som_input_size / max(source_size)
+            image.draft('RGB', (math.ceil(source_size[0] * scale), math.ceil(source_size[1] * scale)))
+            if image.size != source_size:
+                # Results are reported in the coordinates of the image that was sent
+                image.info['source_size'] = source_size
+        # Decode now, while still on the worker thread
+        image.load()
+        return image
+    
+    async def _analyze(self, load_image: Callable[[], Image.Image], task_description: str) -> ORJSONResponse:
+        """Load the image and run the analysis on it"""
+        try:
+            # Initialize OmniParser if needed
+            await self._ensure_initialized()
+            
+            # Run decoding and analysis off the event loop
+            async with self._sem:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._load_and_run_analysis, load_image, task_description
                 )
-                
-                return result
             
-            except Exception as e:
-                logger.error(f"Error analyzing image: {e}")
-                raise HTTPException(status_code=500, detail=str(e))
+            # Returned as a response directly, which skips FastAPI's jsonable_encoder pass
+            return ORJSONResponse(result)
+        
+        except Exception as e:
+            logger.error(f"Error analyzing image: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+    
+    async def _ensure_initialized(self):
+        """Initialize and warm up OmniParser models exactly once"""
+        async with self._init_lock:
+            if self._omniparser is None:
+                await self._initialize_omniparser()
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._warm_up)
     
     async def _initialize_omniparser(self):
         """Initialize OmniParser models"""
         try:
-            import sys
-            import os
-            
-            # Add OmniParser to path
-            omniparser_path = os.path.join(os.path.dirname(__file__), '..', '..', 'OmniParser')
-            if omniparser_path not in sys.path:
-                sys.path.append(omniparser_path)
-            
-            from OmniParser.som import SoMModel
-            from OmniParser.caption import CaptionModel
-            
-            # Get configuration from environment
-            som_model_path = os.environ.get("SOM_MODEL_PATH")
-            caption_model_name = os.environ.get("CAPTION_MODEL_NAME")
-            caption_model_path = os.environ.get("CAPTION_MODEL_PATH")
-            device = os.environ.get("OMNI_PARSER_DEVICE", "cpu")
-            box_threshold = float(os.environ.get("BOX_THRESHOLD", "0.05"))
+            if CFG.device == "cpu":
+                # Split the cores between the inference workers so intra-op threads don't fight
+                torch.set_num_threads(max(1, (os.cpu_count() or 1) // CFG.workers))
             
             # Initialize models
             som_model = SoMModel(
-                model_path=som_model_path,
-                device=device,
-                box_threshold=box_threshold
+                model_path=CFG.som_model_path,
+                device=CFG.device,
+                box_threshold=CFG.box_threshold
             )
             
             caption_model = CaptionModel(
-                model_name=caption_model_name,
-                model_path=caption_model_path,
-                device=device
+                model_name=CFG.caption_model_name,
+                model_path=CFG.caption_model_path,
+                device=CFG.device
             )
             
             self._omniparser = {
@@ -111,34 +268,109 @@ class OmniParserServer:
             logger.error(f"Error initializing OmniParser: {e}")
             raise
     
+    @torch.inference_mode()
+    def _warm_up(self):
+        """Run one synthetic detection and caption so that the first request does not pay for kernel setup"""
+        try:
+            self._omniparser['som'].detect(Image.new('RGB', (224, 224)))
+            # Also surfaces CAPTION_DTYPE problems (e.g. bf16 on pre-Ampere GPUs) at startup
+            self._generate_captions([Image.new('RGB', (64, 64))])
+        except Exception as e:
+            logger.warning(f"OmniParser warm-up failed: {e}")
+    
+    def _generate_captions(self, crops: List[Image.Image]) -> List[str]:
+        """Caption the element crops, in batches of at most CAPTION_MAX_BATCH"""
+        caption_model = self._omniparser['caption']
+        
+        # Lower precision halves activation bandwidth for the memory-bound captioner;
+        # autocast handles the fp32 inputs from the processor, which cast weights would reject
+        use_autocast = CFG.device != "cpu" and CFG.caption_dtype != torch.float32
+        with torch.autocast(device_type=torch.device(CFG.device).type, dtype=CFG.caption_dtype, enabled=use_autocast):
+            if hasattr(caption_model, 'generate_captions_batch'):
+                captions = []
+                crops_iter = iter(crops)
+                while batch := list(itertools.islice(crops_iter, CFG.caption_max_batch)):
+                    captions.extend(caption_model.generate_captions_batch(batch))
+                return captions
+            return [caption_model.generate_caption(element_image) for element_image in crops]
+    
+    def _load_and_run_analysis(self, load_image: Callable[[], Image.Image], task_description: str) -> Dict[str, Any]:
+        """Load the image in the worker thread, then analyze it"""
+        image = load_image()
+        # Drop alpha/palette data once so every downstream buffer uses the 3-byte layout
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return self._run_analysis(image, task_description)
+    
+    @torch.inference_mode()
     def _run_analysis(self, image: Image.Image, task_description: str) -> Dict[str, Any]:
         """Run OmniParser analysis"""
         try:
             som_model = self._omniparser['som']
-            caption_model = self._omniparser['caption']
             
             # Run SoM detection
             som_results = som_model.detect(image)
             
+            # Crop with array views instead of copying a PIL image per box
+            image_array = np.asarray(image)
+            
+            boxes = np.asarray(som_results['boxes'], dtype=np.float64).reshape(-1, 4)
+            scores = np.asarray(som_results['scores'], dtype=np.float64)
+            
+            # Drop low-confidence and (optionally) duplicate boxes before the expensive captioning
+            keep = np.flatnonzero(scores >= CFG.box_threshold)
+            if CFG.nms_iou_threshold is not None and len(keep) > 0:
+                nms_keep = torchvision.ops.nms(
+                    torch.from_numpy(boxes[keep]), torch.from_numpy(scores[keep]), CFG.nms_iou_threshold
+                )
+                keep = np.sort(keep[nms_keep.numpy()])
+            boxes = boxes[keep]
+            scores = scores[keep]
+            
+            # Cast all boxes, centers and scores in one step instead of per element
+            int_box_array = boxes.astype(np.int32)
+            int_boxes = int_box_array.tolist()
+            
+            # Array slices wrap around on negative indices where Image.crop padded, so keep each
+            # crop inside the image and at least one pixel wide
+            image_limits = np.array([image.width, image.height])
+            crop_mins = np.clip(int_box_array[:, 0:2], 0, image_limits - 1)
+            crop_maxs = np.clip(int_box_array[:, 2:4], crop_mins + 1, image_limits)
+            crop_boxes = np.hstack([crop_mins, crop_maxs]).tolist()
+            
+            source_size = image.info.get('source_size')
+            if source_size is not None:
+                # The image was decoded at a reduced scale; map boxes back to the original pixels
+                scale_x = source_size[0] / image.width
+                scale_y = source_size[1] / image.height
+                boxes = boxes * np.array([scale_x, scale_y, scale_x, scale_y])
+                int_boxes = boxes.astype(np.int32).tolist()
+            centers = ((boxes[:, 0:2] + boxes[:, 2:4]) / 2).astype(np.int32).tolist()
+            scores = scores.tolist()
+            
+            crops = [
+                Image.fromarray(image_array[y1:y2, x1:x2])
+                for x1, y1, x2, y2 in crop_boxes
+            ]
+            
             # Generate captions for detected elements
-            elements = []
-            for i, (box, score) in enumerate(zip(som_results['boxes'], som_results['scores'])):
-                x1, y1, x2, y2 = box
-                element_image = image.crop((x1, y1, x2, y2))
-                caption = caption_model.generate_caption(element_image)
-                
-                elements.append({
+            captions = self._generate_captions(crops)
+            
+            elements = [
+                {
                     'id': i,
-                    'box': [int(x1), int(y1), int(x2), int(y2)],
-                    'score': float(score),
+                    'box': box,
+                    'score': score,
                     'caption': caption,
-                    'center': [int((x1 + x2) / 2), int((y1 + y2) / 2)]
-                })
+                    'center': center
+                }
+                for i, (box, score, caption, center) in enumerate(zip(int_boxes, scores, captions, centers))
+            ]
             
             return {
                 'elements': elements,
                 'total_elements': len(elements),
-                'image_size': [image.width, image.height],
+                'image_size': list(source_size or image.size),
                 'task_description': task_description
             }
         
@@ -150,13 +382,13 @@ async def serve():
     """Start the server"""
     server = OmniParserServer()
     
-    host = os.environ.get("SSE_HOST", "127.0.0.1")
-    port = int(os.environ.get("SSE_PORT", "8000"))
+    # Load the models before accepting requests
+    await server._ensure_initialized()
     
     config = uvicorn.Config(
         server.app,
-        host=host,
-        port=port,
+        host=CFG.host,
+        port=CFG.port,
         log_level="info"
     )
     